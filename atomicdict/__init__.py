@@ -16,9 +16,168 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from collections import deque
+from itertools import count
 from threading import Lock
+from time import sleep
 
-from atomicdict.dict_transaction import DictTransaction, DictTransactionError
+from atomicdict.dict_transaction import DictTransaction, DictTransactionError, TransactionRetry
+
+try:
+    from immutables import Map
+except ImportError:
+    Map = None
+
+# HamtAtomicDict stores with at least this many items are kept in a HAMT.
+# Smaller stores are kept in a dict, where a full copy is cheaper than a HAMT update.
+HAMT_MIN_SIZE = 64
+
+# The retry policy of AtomicDict.run_transaction()
+DEFAULT_TRANSACTION_RETRY = TransactionRetry()
+
+# Marks a missing key
+_MISSING = object()
+
+
+class _SingleKeyWrite(object):
+    """
+    A single key write (or remove) waiting to be applied by the update lock holder.
+    """
+
+    __slots__ = ('key', 'item', 'remove', 'prev_item', 'applied', 'error')
+
+    def __init__(self, key, item, remove):
+        self.key = key
+        self.item = item
+        self.remove = remove
+        # The removed item (_MISSING if the key was not available)
+        self.prev_item = _MISSING
+        self.applied = False
+        self.error = None
+
+
+def _freeze_store(store, hamt_min_size):
+    """
+    Wrap a dict with the most suitable immutable store type for its size.
+
+    :param store: A dict (will not be modified)
+    :param hamt_min_size: The minimal size of a HAMT store (None to never use a HAMT)
+    :return: A store that should never be edited
+    """
+    if hamt_min_size is not None and len(store) >= hamt_min_size:
+        return Map(store)
+    return store
+
+
+def _next_store(store, write_dict, remove_keys, hamt_min_size):
+    """
+    Creates a new store with the updates, without modifying the original store.
+
+    :param store: The current store
+    :param write_dict: A dict contains the updates
+    :param remove_keys: A list of keys to be removed
+    :param hamt_min_size: The minimal size of a HAMT store (None to never use a HAMT)
+    :return: The new store
+    """
+    if hamt_min_size is not None and len(store) + len(write_dict) >= hamt_min_size:
+        if type(store) is not Map:
+            store = Map(store)
+        # O(log N) per update using structural sharing
+        with store.mutate() as local_store:
+            local_store.update(write_dict)
+            for k in remove_keys:
+                local_store.pop(k, None)
+            return local_store.finish()
+
+    # A single dict display: copy and update without any method call
+    local_store = {**store, **write_dict}
+    for k in remove_keys:
+        local_store.pop(k, None)
+    return local_store
+
+
+def _next_store_single(store, key, item, remove, hamt_min_size):
+    """
+    Same as _next_store(), for a single key.
+
+    :param store: The current store
+    :param key: The key to write or remove
+    :param item: The value to write
+    :param remove: If True, the key is removed (it must be in the store)
+    :param hamt_min_size: The minimal size of a HAMT store (None to never use a HAMT)
+    :return: The new store
+    """
+    if hamt_min_size is not None and len(store) >= hamt_min_size:
+        if type(store) is not Map:
+            store = Map(store)
+        if remove:
+            return store.delete(key)
+        return store.set(key, item)
+
+    if remove:
+        local_store = dict(store)
+        del local_store[key]
+        return local_store
+    return {**store, key: item}
+
+
+def _next_store_ops(store, ops, hamt_min_size):
+    """
+    Creates a new store with a batch of single key writes, without modifying the original store.
+
+    :param store: The current store
+    :param ops: A list of _SingleKeyWrite objects
+    :param hamt_min_size: The minimal size of a HAMT store (None to never use a HAMT)
+    :return: The new store, or None if there is nothing to update
+    """
+    if len(ops) == 1:
+        op = ops[0]
+        if op.remove:
+            op.prev_item = store.get(op.key, _MISSING)
+            if op.prev_item is _MISSING:
+                # Nothing to remove
+                return None
+        return _next_store_single(store, op.key, op.item, op.remove, hamt_min_size)
+
+    write_dict = {}
+    remove_keys = set()
+    for op in ops:
+        if op.remove:
+            # The removed item is the one written by a previous op in the batch, if any
+            if op.key in write_dict:
+                op.prev_item = write_dict.pop(op.key)
+            elif op.key not in remove_keys:
+                op.prev_item = store.get(op.key, _MISSING)
+            remove_keys.add(op.key)
+        else:
+            write_dict[op.key] = op.item
+            remove_keys.discard(op.key)
+    return _next_store(store, write_dict, remove_keys, hamt_min_size)
+
+
+def _transaction_store(transaction, hamt_min_size):
+    """
+    Creates a new store with the changes of a transaction, without modifying its base store.
+
+    :param transaction: A modified transaction object
+    :param hamt_min_size: The minimal size of a HAMT store (None to never use a HAMT)
+    :return: The new store
+    """
+    base_store = transaction.base_store
+    changed_keys = transaction.changed_keys
+    if type(base_store) is Map and changed_keys is not None:
+        # Only apply the changed keys, to keep the structural sharing of the HAMT
+        with base_store.mutate() as local_store:
+            for k in changed_keys:
+                item = transaction.get(k, _MISSING)
+                if item is _MISSING:
+                    local_store.pop(k, None)
+                else:
+                    local_store[k] = item
+            return local_store.finish()
+
+    # The transaction itself may still be edited by the user, so it is not published as is
+    return _freeze_store(transaction.copy(), hamt_min_size)
 
 
 class AtomicDict(object):
@@ -28,6 +187,11 @@ class AtomicDict(object):
     Also support transaction using begin_transaction() and commit_transaction().
     """
 
+    __slots__ = ('__store__', '__ver__', '__update_store_lock__', '__pending__', '__weakref__')
+
+    # The minimal size of a HAMT store (None to never use a HAMT). See HamtAtomicDict.
+    hamt_min_size = None
+
     def __init__(self, *args, **kwargs):
         """
         Initiate AtomicDict similarly to dict().
@@ -35,12 +199,39 @@ class AtomicDict(object):
         :param args, kwargs: see dict()
         """
 
-        # self.__immutable_store__ is immutable.
-        # Once a a tuple (ver, dict) is assigned to this member, it should never be edited.
+        # self.__store__ is immutable.
+        # Once a store is assigned to this member, it should never be edited.
         # Therefore, any read operation on the object is inherently atomic, and thus wait-free.
-        # A user should never access this member.
-        self.__immutable_store__ = (0, dict(*args, **kwargs))
+        # The store is a dict, or a HAMT (immutables.Map) for large stores of HamtAtomicDict.
+        # self.__ver__ is a sequence lock: it is odd while a new store is being published,
+        # and the version of the store is self.__ver__ // 2.
+        # A user should never access these members.
+        self.__store__ = _freeze_store(dict(*args, **kwargs), self.hamt_min_size)
+        self.__ver__ = 0
         self.__update_store_lock__ = Lock()
+        # Single key writes waiting to be applied by the update lock holder
+        self.__pending__ = deque()
+
+    @property
+    def __immutable_store__(self):
+        # Retry until the store was read without a concurrent publication (sequence lock)
+        while True:
+            seq = self.__ver__
+            store = self.__store__
+            if seq & 1 == 0 and seq == self.__ver__:
+                return seq >> 1, store
+
+    def _publish_store(self, new_store):
+        """
+        Publish a new store. Must be called while holding the update lock.
+
+        :param new_store: The new store (should never be edited afterwards)
+        """
+        seq = self.__ver__
+        self.__ver__ = seq + 1
+        # Linearization point
+        self.__store__ = new_store
+        self.__ver__ = seq + 2
 
     ####################################################################
     # Atomic Ops
@@ -52,29 +243,91 @@ class AtomicDict(object):
         Updates the dict atomically.
         A corresponding read will see none of the modifications or all of them.
 
-        :param write_dict: A dict contains the updates
+        :param write_dict: A dict contains the updates (or an iterable of key/value pairs)
         :param read_keys: A list of keys to read
         :param remove_keys: A list of keys to be removed
         :param default_value: A default value in case the key is not available
         :return: A dict of the values matching the requested keys
         """
+        if write_dict is not None and not isinstance(write_dict, dict):
+            write_dict = dict(write_dict)
+        if not write_dict and not remove_keys:
+            # Nothing to write: a wait-free read of the current snapshot is sufficient
+            return self.atomic_waitfree_read(read_keys, default_value)
+
         if write_dict is None:
             write_dict = {}
         with self.__update_store_lock__:
-            ver, store = self.__immutable_store__
-            read_values = {k: store.get(k, default_value) for k in read_keys}
-
-            local_store = store.copy()
-            local_store.update(write_dict)
-            for k in remove_keys:
-                if k in local_store:
-                    del local_store[k]
+            store = self.__store__
+            if read_keys:
+                # The reads are done on the original store, which is never modified
+                read_values = {k: store.get(k, default_value) for k in read_keys}
+            else:
+                read_values = {}
 
-            # Linearization point
-            self.__immutable_store__ = (ver + 1, local_store)
+            local_store = _next_store(store, write_dict, remove_keys, self.hamt_min_size)
+            self._publish_store(local_store)
 
             return read_values
 
+    def _coalesced_write(self, key, item=None, remove=False):
+        """
+        Writes or removes a single key atomically.
+        Concurrent calls are coalesced: the update lock holder applies all the pending writes
+        with a single new store, while the other writers wait for the lock.
+
+        :param key: The key to write or remove
+        :param item: The value to write
+        :param remove: If True, the key is removed instead
+        :return: The removed item (_MISSING if the key was not available)
+        """
+        op = _SingleKeyWrite(key, item, remove)
+        pending = self.__pending__
+        pending.append(op)
+        with self.__update_store_lock__:
+            if not op.applied:
+                # Ops are only removed while holding the lock, so this op is still pending
+                ops = [pending.popleft() for _ in range(len(pending))]
+                if not ops:
+                    return
+                try:
+                    self._apply_pending_ops(ops)
+                except BaseException:
+                    # Only the ops of other writers are returned to the queue
+                    pending.extendleft(reversed([o for o in ops if not o.applied and o is not op]))
+                    raise
+
+        if op.error is not None:
+            raise op.error
+        return op.prev_item
+
+    def _apply_pending_ops(self, ops):
+        """
+        Applies a batch of single key write ops. Must be called while holding the update lock.
+        Each op is marked as applied, along with its error (if any).
+
+        :param ops: A list of _SingleKeyWrite objects
+        """
+        try:
+            new_store = _next_store_ops(self.__store__, ops, self.hamt_min_size)
+        except Exception:
+            # A bad key fails the whole batch. Apply the ops one by one,
+            # so each error is raised only by the writer of the failed op.
+            for o in ops:
+                try:
+                    new_store = _next_store_ops(self.__store__, (o,), self.hamt_min_size)
+                except Exception as e:
+                    o.error = e
+                else:
+                    if new_store is not None:
+                        self._publish_store(new_store)
+                o.applied = True
+        else:
+            if new_store is not None:
+                self._publish_store(new_store)
+            for o in ops:
+                o.applied = True
+
     def atomic_waitfree_read(self, keys, default_value=None):
         """
         Read many keys atomically and promised to never wait.
@@ -86,8 +339,12 @@ class AtomicDict(object):
         """
 
         # Linearization point
-        ver, store = self.__immutable_store__
+        store = self.__store__
 
+        if isinstance(keys, (tuple, list)) and len(keys) == 1:
+            # Avoids the comprehension overhead for a single key
+            k = keys[0]
+            return {k: store.get(k, default_value)}
         return {k: store.get(k, default_value) for k in keys}
 
     ####################################################################
@@ -113,35 +370,59 @@ class AtomicDict(object):
         :param transaction: A transaction object obtained by
         :return: True if successful, raise exception otherwise
         """
+        if not transaction.is_modified:
+            # Read-only transaction: nothing to publish
+            transaction.validate_transaction(self)
+            return True
+
+        new_store = _transaction_store(transaction, self.hamt_min_size)
         with self.__update_store_lock__:
-            ver, store = self.__immutable_store__
-            new_store = transaction.data
             transaction.validate_transaction(self)
-            self.__immutable_store__ = (ver + 1, new_store)
-            transaction.data = None
+            self._publish_store(new_store)
 
         return True
 
     def run_transaction(self, transaction_func, *args, **kwargs):
         """
         Run a transaction functions.
+        A failed transaction is retried according to DEFAULT_TRANSACTION_RETRY.
 
         :param transaction_func: A func object that accept a transaction object as its first parameter.
         :param args, kwargs: Arguments for the transaction function.
         :return: The transaction_func return value if successful.
         """
-        success = False
-        ret_value = None
-        while not success:
+        return self.run_transaction_with_retry(DEFAULT_TRANSACTION_RETRY, transaction_func, *args, **kwargs)
+
+    def run_transaction_with_retry(self, retry, transaction_func, *args, **kwargs):
+        """
+        Run a transaction functions.
+        A failed transaction is retried after a backoff, up to the maximal number of attempts.
+
+        :param retry: A TransactionRetry object.
+        :param transaction_func: A func object that accept a transaction object as its first parameter.
+        :param args, kwargs: Arguments for the transaction function.
+        :return: The transaction_func return value if successful.
+        """
+        max_attempts = retry.max_attempts
+        attempts = count(1) if max_attempts is None else range(1, max_attempts + 1)
+        conflicts = 0
+        for attempt in attempts:
+            committing = False
             try:
                 transaction = self.begin_transaction()
                 ret_value = transaction_func(transaction, *args, **kwargs)
+                committing = True
                 transaction.commit()
-            except DictTransactionError:
-                success = False
-            else:
-                success = True
-        return ret_value
+                return ret_value
+            except DictTransactionError as e:
+                error = e
+            if committing:
+                conflicts += 1
+            if attempt != max_attempts:
+                sleep(retry.delay(attempt))
+
+        raise DictTransactionError(self, error.version, f"Transaction failed after {max_attempts} attempts",
+                                   conflict_ratio=conflicts / max_attempts) from error
 
     ####################################################################
     # Inherently atomic dict ops
@@ -149,47 +430,46 @@ class AtomicDict(object):
 
     @property
     def ver(self):
-        ver, store = self.__immutable_store__
-        return ver
+        return self.__ver__ >> 1
 
     def __len__(self):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return len(store)
 
     def __repr__(self):
-        ver, store = self.__immutable_store__
-        return repr(store)
+        store = self.__store__
+        return repr(dict(store))
 
     def copy(self):
-        ver, store = self.__immutable_store__
-        return store.copy()
+        store = self.__store__
+        return dict(store)
 
     def __getitem__(self, key):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return store[key]
 
     def get(self, key, default_value=None):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return store.get(key, default_value)
 
     def __contains__(self, item):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return item in store
 
     def __iter__(self):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return iter(store)
 
     def items(self):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return store.items()
 
     def keys(self):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return store.keys()
 
     def values(self):
-        ver, store = self.__immutable_store__
+        store = self.__store__
         return store.values()
 
     ####################################################################
@@ -198,19 +478,51 @@ class AtomicDict(object):
 
     def clear(self):
         with self.__update_store_lock__:
-            ver, store = self.__immutable_store__
-            self.__immutable_store__ = (ver + 1, dict())
+            self._publish_store(dict())
 
     def update(self, *args, **kwargs):
-        self.atomic_write_read(write_dict=dict(*args, **kwargs))
+        if not kwargs and len(args) == 1 and isinstance(args[0], dict):
+            # The write dict is only read, so there is no need to copy it
+            write_dict = args[0]
+        else:
+            write_dict = dict(*args, **kwargs)
+        self.atomic_write_read(write_dict=write_dict)
 
     def __setitem__(self, key, item):
-        self.atomic_write_read(write_dict={key: item})
+        self._coalesced_write(key, item)
 
     def __delitem__(self, key):
-        self.atomic_write_read(remove_keys=(key,))
+        self._coalesced_write(key, remove=True)
 
     def pop(self, key, default_value=None):
-        res = self.atomic_write_read(read_keys=(key,), remove_keys=(key,),
-                                     default_value=default_value)
-        return res[key]
+        res = self._coalesced_write(key, remove=True)
+        if res is _MISSING:
+            return default_value
+        return res
+
+
+class HamtAtomicDict(AtomicDict):
+    """
+    An AtomicDict that keeps stores with at least HAMT_MIN_SIZE items in a HAMT (requires immutables).
+    A write to a large store is O(log N) using structural sharing, instead of a full copy.
+
+    The trade-offs for large stores:
+    - The iteration order is the HAMT hash order rather than the insertion order.
+    - keys(), items() and values() return immutables views rather than dict views.
+    - copy(), repr() and begin_transaction() must convert the HAMT to a dict,
+      which is an order of magnitude slower than copying a dict.
+    """
+
+    __slots__ = ()
+
+    hamt_min_size = HAMT_MIN_SIZE
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initiate HamtAtomicDict similarly to dict().
+
+        :param args, kwargs: see dict()
+        """
+        if Map is None:
+            raise ImportError("HamtAtomicDict requires immutables (pip install atomicdict[hamt])")
+        AtomicDict.__init__(self, *args, **kwargs)
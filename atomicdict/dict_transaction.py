@@ -16,17 +16,53 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from collections import UserDict
+from random import random
 
 
 class DictTransactionError(Exception):
-    def __init__(self, source, version, msg=None):
+    def __init__(self, source, version, msg=None, conflict_ratio=None):
         self.source = source
         self.version = version
+        # The ratio of attempts that failed to commit due to a concurrent update.
+        # Only set by AtomicDict.run_transaction_with_retry() once it gives up.
+        self.conflict_ratio = conflict_ratio
         Exception.__init__(self, msg)
 
 
-class DictTransaction(UserDict):
+class TransactionRetry(object):
+    """
+    A retry policy for AtomicDict.run_transaction_with_retry(): exponential backoff with optional jitter.
+    """
+
+    __slots__ = ('max_attempts', 'base_delay', 'jitter')
+
+    def __init__(self, max_attempts=16, base_delay=1e-4, jitter=True):
+        """
+        :param max_attempts: Maximal number of attempts, at least 1 (None for unlimited).
+        :param base_delay: The backoff delay (in seconds) after the first failed attempt.
+            Note that time.sleep() usually cannot sleep less than ~50us.
+        :param jitter: If True, a random delay of up to base_delay is added to each backoff.
+        """
+        if max_attempts is not None and max_attempts < 1:
+            raise ValueError(f"max_attempts must be at least 1 (or None): {max_attempts}")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        :param attempt: The number of the failed attempt (starting from 1).
+        :return: The backoff delay (in seconds) before the next attempt.
+        """
+        delay = self.base_delay * (1 << min(attempt - 1, 10))
+        if self.jitter:
+            delay += random() * self.base_delay
+        return delay
+
+
+class DictTransaction(dict):
+
+    __slots__ = ('__source__', '__ver__', '__base__', '__changed__', '__committed__', '__weakref__')
 
     def __init__(self, source_atomic_dict, source_ver, source_store):
         """
@@ -36,9 +72,12 @@ class DictTransaction(UserDict):
         :param source_ver: The version of the store.
         :param source_store: The store (will be copied).
         """
-        UserDict.__init__(source_store)
+        dict.__init__(self, source_store)
         self.__source__ = source_atomic_dict
         self.__ver__ = source_ver
+        self.__base__ = source_store
+        # The keys that were written or removed (None if all the keys may have changed)
+        self.__changed__ = set()
         self.__committed__ = False
 
     @property
@@ -53,6 +92,63 @@ class DictTransaction(UserDict):
     def is_committed(self):
         return self.__committed__
 
+    @property
+    def base_store(self):
+        return self.__base__
+
+    @property
+    def changed_keys(self):
+        return self.__changed__
+
+    @property
+    def is_modified(self):
+        return self.__changed__ is None or bool(self.__changed__)
+
+    def _mark_changed(self, keys):
+        changed = self.__changed__
+        if changed is not None:
+            changed.update(keys)
+
+    ########################################################################################################
+    # Dict write ops (track the changed keys)
+    ########################################################################################################
+
+    def __setitem__(self, key, item):
+        dict.__setitem__(self, key, item)
+        self._mark_changed((key,))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark_changed((key,))
+
+    def pop(self, key, *args):
+        if key in self:
+            self._mark_changed((key,))
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, item = dict.popitem(self)
+        self._mark_changed((key,))
+        return key, item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._mark_changed((key,))
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        dict.update(self, other)
+        self._mark_changed(other)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        dict.clear(self)
+        self.__changed__ = None
+
     def validate_transaction(self, atomic_dict):
         """
         Validate the transaction.
@@ -22,6 +22,7 @@ setup(
     name="atomicdict",
     version="0.1.0",
     py_modules=['atomicdict'],
+    extras_require={'hamt': ['immutables']},
     description="Wait-free-lock-free read/write/remove (maximum possible performance) with optional transaction mode.",
     author="Liran Funaro",
     author_email="liran.funaro+atomicdict@gmail.com",
@@ -18,9 +18,12 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from random import sample
 from threading import Event, Thread
-from unittest import TestCase
+from time import sleep
+from unittest import TestCase, skipIf
+from weakref import ref
 
-from atomicdict import AtomicDict
+import atomicdict
+from atomicdict import AtomicDict, DictTransactionError, HamtAtomicDict, TransactionRetry
 
 
 def update_forever(d, e, update_set):
@@ -31,10 +34,27 @@ def update_forever(d, e, update_set):
         d.atomic_write_read(write_dict=local)
 
 
+class BlockingKey(object):
+    """
+    A key that blocks on its first hash until released.
+    """
+    def __init__(self, release):
+        self.release = release
+        self.blocked = False
+
+    def __hash__(self):
+        if not self.blocked:
+            self.blocked = True
+            self.release.wait()
+        return 0
+
+
 class TestAtomicDict(TestCase):
+    dict_type = AtomicDict
+
     def test_write_vs_read(self):
-        d = AtomicDict({b: 0 for b in range(10000)})
-        update_set = sample(d.keys(), 20)
+        d = self.dict_type({b: 0 for b in range(10000)})
+        update_set = sample(list(d.keys()), 20)
         e = Event()
         Thread(target=update_forever, args=(d, e, update_set)).start()
         try:
@@ -45,3 +65,269 @@ class TestAtomicDict(TestCase):
                 self.assertTrue(all_ok)
         finally:
             e.set()
+
+    def test_write_remove_large(self):
+        d = self.dict_type({b: 0 for b in range(1000)})
+        d.atomic_write_read(write_dict={0: 1, 1000: 2}, remove_keys=(1, 2, -1))
+        self.assertEqual(d[0], 1)
+        self.assertEqual(d[1000], 2)
+        self.assertNotIn(1, d)
+        self.assertNotIn(2, d)
+        self.assertEqual(len(d), 999)
+        self.assertEqual(d.copy(), {**{b: 0 for b in range(3, 1000)}, 0: 1, 1000: 2})
+
+    def test_transaction(self):
+        d = self.dict_type(a=1, b=2)
+        with d.begin_transaction() as t:
+            self.assertEqual(t['a'], 1)
+            t['a'] = 3
+            del t['b']
+            self.assertEqual(d['a'], 1)
+            self.assertIn('b', d)
+        self.assertTrue(t.is_committed)
+        self.assertEqual(d.copy(), {'a': 3})
+
+    def test_transaction_conflict(self):
+        d = self.dict_type(a=1)
+        ver = d.ver
+        t1 = d.begin_transaction()
+        t2 = d.begin_transaction()
+        self.assertEqual(t1['a'], 1)
+        self.assertIsNone(t1.pop('missing', None))
+        t2['a'] = 2
+        t1.commit()
+        self.assertEqual(d.ver, ver)
+        t2.commit()
+        self.assertEqual(d['a'], 2)
+
+        t = d.begin_transaction()
+        t['a'] = 2
+        d['a'] = 3
+        self.assertRaises(DictTransactionError, t.commit)
+        self.assertEqual(d['a'], 3)
+
+    def test_single_key_ops(self):
+        for size in (10, 1000):
+            d = self.dict_type({b: 0 for b in range(size)})
+            d[0] = 1
+            d[size] = 2
+            self.assertEqual(d[0], 1)
+            self.assertEqual(d[size], 2)
+            del d[1]
+            del d[-1]
+            self.assertNotIn(1, d)
+            self.assertEqual(d.pop(0), 1)
+            self.assertEqual(d.pop(0, 'default'), 'default')
+            self.assertEqual(len(d), size - 1)
+
+    def test_run_transaction_max_attempts(self):
+        d = self.dict_type(a=1)
+
+        def conflict(t):
+            t['a'] += 1
+            d['b'] = t['a']
+
+        with self.assertRaises(DictTransactionError) as cm:
+            d.run_transaction_with_retry(TransactionRetry(max_attempts=3), conflict)
+        self.assertEqual(cm.exception.conflict_ratio, 1)
+        self.assertEqual(d['a'], 1)
+
+        def abort(t):
+            t.abort()
+
+        with self.assertRaises(DictTransactionError) as cm:
+            d.run_transaction_with_retry(TransactionRetry(max_attempts=3, jitter=False), abort)
+        self.assertEqual(cm.exception.conflict_ratio, 0)
+
+        def inc(t, amount):
+            t['a'] += amount
+            return t['a']
+
+        self.assertEqual(d.run_transaction(inc, 2), 3)
+        self.assertEqual(d['a'], 3)
+
+        for max_attempts in (0, -1):
+            self.assertRaises(ValueError, TransactionRetry, max_attempts=max_attempts)
+
+        # All the keyword arguments are passed to the transaction function
+        def set_value(t, jitter, max_attempts):
+            t['a'] = (jitter, max_attempts)
+
+        d.run_transaction(set_value, jitter='x', max_attempts='y')
+        self.assertEqual(d['a'], ('x', 'y'))
+
+    def test_transaction_retry_delay(self):
+        retry = TransactionRetry(base_delay=1e-3, jitter=False)
+        self.assertEqual([retry.delay(a) for a in (1, 2, 3, 11, 12)], [1e-3, 2e-3, 4e-3, 1.024, 1.024])
+        retry = TransactionRetry(base_delay=1e-3)
+        self.assertTrue(all(1e-3 <= retry.delay(1) < 2e-3 for _ in range(100)))
+
+    def test_waitfree_read(self):
+        d = self.dict_type(a=1, b=2)
+        keys = ['a', 'b', 'c']
+        res = d.atomic_waitfree_read(keys)
+        self.assertEqual(res, {'a': 1, 'b': 2, 'c': None})
+        res['a'] = 3
+        self.assertEqual(d.atomic_waitfree_read(keys), {'a': 1, 'b': 2, 'c': None})
+        self.assertEqual(d.atomic_waitfree_read(iter(keys), 0), {'a': 1, 'b': 2, 'c': 0})
+        d['c'] = 3
+        self.assertEqual(d.atomic_waitfree_read(keys), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(d.atomic_waitfree_read(['a']), {'a': 1})
+        self.assertEqual(d.atomic_waitfree_read((1, 'a')), {1: None, 'a': 1})
+        res = d.atomic_waitfree_read((True, 'a'))
+        self.assertIs(next(iter(res)), True)
+
+    def test_concurrent_single_key_writes(self):
+        for size in (10, 1000):
+            d = self.dict_type({b: 0 for b in range(size)})
+
+            def write(t):
+                for i in range(2000):
+                    d[t, i] = i
+                    if i % 3 == 0:
+                        del d[t, i]
+
+            threads = [Thread(target=write, args=(t,)) for t in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            expected = {b: 0 for b in range(size)}
+            expected.update({(t, i): i for t in range(8) for i in range(2000) if i % 3 != 0})
+            self.assertEqual(d.copy(), expected)
+
+    def test_concurrent_pop(self):
+        d = self.dict_type({b: b for b in range(1000)})
+        popped = []
+
+        def pop():
+            res = [d.pop(k, None) for k in range(1000)]
+            popped.extend(v for v in res if v is not None)
+
+        threads = [Thread(target=pop) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Each item is popped exactly once
+        self.assertEqual(sorted(popped), list(range(1000)))
+        self.assertEqual(len(d), 0)
+
+    def test_coalesced_write_bad_key(self):
+        d = self.dict_type(a=1)
+        release = Event()
+        key = BlockingKey(release)
+        errors = {}
+
+        def write(name, k, v):
+            try:
+                d[k] = v
+            except TypeError as e:
+                errors[name] = e
+
+        # The first writer holds the update lock, so the other two writes are applied as one batch
+        threads = [Thread(target=write, args=('blocking', key, 0))]
+        threads[0].start()
+        while not key.blocked:
+            sleep(0.001)
+        threads.extend([Thread(target=write, args=('good', 'b', 42)),
+                        Thread(target=write, args=('bad', ['x'], 1))])
+        for t in threads[1:]:
+            t.start()
+        sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(list(errors), ['bad'])
+        self.assertEqual(d['b'], 42)
+        self.assertEqual(d[key], 0)
+        self.assertEqual(len(d), 3)
+
+    def test_weakref(self):
+        d = self.dict_type(a=1)
+        self.assertIs(ref(d)(), d)
+        t = d.begin_transaction()
+        self.assertIs(ref(t)(), t)
+
+    def test_transaction_large(self):
+        d = self.dict_type({b: 0 for b in range(1000)})
+        with d.begin_transaction() as t:
+            t[0] = 1
+            t.update({1: 2}, b=3)
+            t.setdefault(2, 5)
+            t.setdefault(1000, 4)
+            del t[3]
+            self.assertEqual(t.pop(4), 0)
+            t |= {5: 6}
+        expected = {b: 0 for b in range(6, 1000)}
+        expected.update({0: 1, 1: 2, 'b': 3, 2: 0, 1000: 4, 5: 6})
+        self.assertEqual(d.copy(), expected)
+
+        with d.begin_transaction() as t:
+            t.clear()
+            t['a'] = 1
+        self.assertEqual(d.copy(), {'a': 1})
+
+    def test_iteration_order(self):
+        keys = [str(i) for i in reversed(range(atomicdict.HAMT_MIN_SIZE - 1))]
+        d = self.dict_type({k: 0 for k in keys})
+        d['x'] = 0
+        self.assertEqual(list(d), keys + ['x'])
+        self.assertEqual(list(d.copy()), keys + ['x'])
+
+        # Crossing HAMT_MIN_SIZE keeps the items, but the order is only kept without a HAMT
+        d['y'] = 0
+        if self.dict_type.hamt_min_size is None:
+            self.assertEqual(list(d), keys + ['x', 'y'])
+        else:
+            self.assertCountEqual(list(d), keys + ['x', 'y'])
+        self.assertEqual(d.copy(), dict.fromkeys(keys + ['x', 'y'], 0))
+
+    def test_views(self):
+        d = self.dict_type({b: b for b in range(100)})
+        self.assertEqual(set(d.keys()), set(range(100)))
+        self.assertEqual(sorted(d.items()), [(b, b) for b in range(100)])
+        if self.dict_type.hamt_min_size is None:
+            self.assertEqual(d.keys() & {1, 2, 100}, {1, 2})
+            self.assertEqual(d.items() | set(), {(b, b) for b in range(100)})
+            self.assertEqual(d.keys(), set(range(100)))
+            self.assertEqual(list(reversed(d.keys())), list(reversed(range(100))))
+
+    def test_waitfree_read_concurrent_writer(self):
+        d = self.dict_type({b: 0 for b in range(100)})
+        keys = list(range(0, 100, 5))
+        e = Event()
+
+        def write():
+            for i in range(1, 2001):
+                d.update({k: i for k in keys})
+            e.set()
+
+        t = Thread(target=write)
+        t.start()
+        try:
+            last = 0
+            while not e.is_set():
+                res = d.atomic_waitfree_read(keys)
+                val = res[keys[0]]
+                self.assertTrue(all(res[k] == val for k in keys))
+                self.assertGreaterEqual(val, last)
+                last = val
+                # Editing the result must not affect the next reads
+                res[keys[0]] = -1
+        finally:
+            t.join()
+        self.assertEqual(d.atomic_waitfree_read(keys), dict.fromkeys(keys, 2000))
+
+    def test_write_pairs(self):
+        d = self.dict_type(a=1)
+        d.atomic_write_read(write_dict=[('b', 2), ('c', 3)])
+        self.assertEqual(d.copy(), {'a': 1, 'b': 2, 'c': 3})
+
+
+@skipIf(atomicdict.Map is None, "immutables is not installed")
+class TestHamtAtomicDict(TestAtomicDict):
+    dict_type = HamtAtomicDict